@@ -1,57 +1,301 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g
 import sqlite3
+import queue
+import threading
 import os
 import json
+import hashlib
+import hmac
+from contextlib import contextmanager
 from datetime import datetime
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, init runs unlocked
+    fcntl = None
+
+try:
+    import ijson
+except ImportError:  # optional: only used to stream very large menu.json files
+    ijson = None
 
 app = Flask(__name__)
 app.secret_key = "supersecret"
 DB_NAME = "hotel.db"
+# Bump whenever create_schema() changes so existing databases get upgraded on startup
+SCHEMA_VERSION = 3
+# menu.json files at least this big are streamed with ijson; below it json.load is faster
+MENU_STREAM_THRESHOLD = 1024 * 1024
+MENU_PARSE_ERRORS = (json.JSONDecodeError, ijson.JSONError) if ijson else (json.JSONDecodeError,)
+
+# Per-connection tuning. journal_mode=WAL is persistent, so it is set once in init_db().
+DB_PRAGMAS = """
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-20000;
+"""
+
+# SQL kept as module constants so sqlite3's per-connection statement cache
+# (keyed by the exact SQL text) reuses the prepared statements across requests
+SQL_ASSIGN_ORDER = "UPDATE orders SET delivery_partner = ?, status = 'preparing' WHERE id = ?"
+SQL_UPDATE_ORDER_STATUS = "UPDATE orders SET status = ? WHERE id = ?"
+SQL_UPDATE_DELIVERY_STATUS = "UPDATE orders SET status = ? WHERE id = ? AND delivery_partner = ?"
+SQL_ADD_TO_CART = """
+    INSERT INTO cart (user_id, dish_id, quantity) VALUES (?, ?, 1)
+    ON CONFLICT(user_id, dish_id) DO UPDATE SET quantity = quantity + 1
+"""
+SQL_CART_ITEMS = """
+    SELECT 
+        c.id AS cart_id, 
+        d.id AS dish_id, 
+        d.name, 
+        d.price, 
+        c.quantity, 
+        d.price * c.quantity AS subtotal,
+        SUM(d.price * c.quantity) OVER () AS grand_total
+    FROM cart c
+    JOIN dishes d ON c.dish_id = d.id
+    WHERE c.user_id = ?
+"""
+SQL_INSERT_ORDER = """
+    INSERT INTO orders (user_id, total_price, timestamp) VALUES (?, ?, ?)
+    RETURNING id, total_price, status, delivery_partner, timestamp
+"""
+SQL_INSERT_ORDER_ITEM = """
+    INSERT INTO order_items 
+    (order_id, dish_id, dish_name, quantity, total) 
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_USER_ORDER = "SELECT total_price, status, delivery_partner, timestamp FROM orders WHERE id=? AND user_id=?"
+SQL_ORDER_ITEMS = """
+    SELECT dish_name, quantity, total 
+    FROM order_items 
+    WHERE order_id = ?
+    ORDER BY id
+"""
+SQL_USER_ORDERS = """
+    SELECT 
+        id, total_price, status, delivery_partner, timestamp
+    FROM orders
+    WHERE user_id=?
+    ORDER BY timestamp DESC
+"""
+SQL_ALL_ORDERS = """
+    SELECT 
+        o.id, 
+        COALESCE(u.username, 'Unknown User') AS customer_username, 
+        o.total_price AS total, 
+        o.status, 
+        o.delivery_partner, 
+        o.timestamp
+    FROM orders o
+    LEFT JOIN users u ON o.user_id = u.id
+    ORDER BY o.timestamp DESC
+"""
+SQL_DELIVERY_ORDERS = """
+    SELECT 
+        o.id, 
+        u.username AS customer_username, 
+        o.total_price, 
+        o.status, 
+        o.timestamp
+    FROM orders o
+    JOIN users u ON o.user_id = u.id
+    WHERE o.delivery_partner = ?
+    ORDER BY o.timestamp DESC
+"""
+# Room for every statement above plus the ad-hoc ones, so none gets evicted and re-prepared
+DB_CACHED_STATEMENTS = 256
+
+
+# Request handlers borrow long-lived connections from this pool instead of reopening the db
+DB_POOL_SIZE = 8
+_pool = queue.Queue(maxsize=DB_POOL_SIZE)
 
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_NAME)
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+    conn.executescript(DB_PRAGMAS)
     conn.row_factory = sqlite3.Row
     return conn
 
+def get_db():
+    """Returns the pooled connection for the current request (opening one if the pool is empty)."""
+    if "db" not in g:
+        try:
+            g.db = _pool.get_nowait()
+        except queue.Empty:
+            g.db = get_db_connection()
+    return g.db
+
+@contextmanager
+def db_cursor():
+    """Yields a cursor on the request's pooled connection; commits on success, rolls back on error."""
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        yield c
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop("db", None)
+    if conn is None:
+        return
+    # Never hand a half-finished transaction to the next request
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+# Dish rows change only when the admin edits the menu, so they are cached per process.
+# The cache is keyed by a version counter in the meta table, which every dish write bumps,
+# so other worker processes notice the change on their next lookup.
+_dish_cache = {"entry": (None, None)}
+
+def bump_dishes_version(c):
+    c.execute("""
+        INSERT INTO meta (key, value) VALUES ('dishes_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    """)
+
+def get_dishes(c):
+    """Returns all dishes, only hitting the dishes table when the menu has changed."""
+    c.execute("SELECT value FROM meta WHERE key = 'dishes_version'")
+    row = c.fetchone()
+    version = row["value"] if row else 0
+
+    cached_version, dishes = _dish_cache["entry"]
+    if cached_version != version:
+        c.execute("SELECT * FROM dishes")
+        dishes = c.fetchall()
+        _dish_cache["entry"] = (version, dishes)
+    return dishes
+
+def hash_password(password, salt=None):
+    """Returns salt + scrypt key for password; this is what users.password_hash stores."""
+    salt = salt or os.urandom(16)
+    return salt + hashlib.scrypt(password.encode(), salt=salt, n=16384, r=8, p=1)
+
+def check_password(password, stored_hash):
+    if not stored_hash:
+        return False
+    return hmac.compare_digest(hash_password(password, stored_hash[:16]), stored_hash)
+
+# Checked against when the email is unknown, so login takes the same time either way
+DUMMY_PASSWORD_HASH = hash_password(os.urandom(16).hex())
+
+def menu_json_signature():
+    """Returns a cheap fingerprint (mtime and size) of menu.json, or None if it is missing."""
+    try:
+        st = os.stat("menu.json")
+    except FileNotFoundError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+def load_cart(c, user_id):
+    """Returns (items, total) for the user's cart, with subtotals computed by SQLite.
+
+    Items are whatever the cursor's row_factory builds: sqlite3.Row for templates,
+    or plain tuples (columns in SQL_CART_ITEMS order) for callers that just unpack them.
+    """
+    c.execute(SQL_CART_ITEMS, (user_id,))
+    items = c.fetchall()
+    total = items[0][-1] if items else 0  # grand_total is the last column
+    return items, total
+
 def load_menu_from_json():
     """Loads dishes from menu.json into the database (if it exists)."""
-    if not os.path.exists("menu.json"):
+    signature = menu_json_signature()
+    if signature is None:
         print("Warning: menu.json not found! Dishes will not be loaded.")
         return
     
-    try:
-        with open("menu.json", "r", encoding="utf-8") as f:
-            dishes = json.load(f)
-    except json.JSONDecodeError:
-        print("Error reading menu.json. Please check file format.")
-        return
+    stream = ijson is not None and os.path.getsize("menu.json") >= MENU_STREAM_THRESHOLD
 
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute("DELETE FROM dishes") # Clear old dishes
-    
-    for dish in dishes:
-        c.execute(
-            "INSERT INTO dishes (name, description, price, image) VALUES (?, ?, ?, ?)",
-            (dish.get("name"), dish.get("description", ""), dish.get("price"), dish.get("image", "default.png"))
-        )
-    conn.commit()
-    conn.close()
+    try:
+        with open("menu.json", "rb") as f:
+            if stream:
+                dishes = ijson.items(f, "item", use_float=True)
+            else:
+                dishes = json.load(f)
+            rows = (
+                (dish.get("name"), dish.get("description", ""), dish.get("price"), dish.get("image", "default.png"))
+                for dish in dishes
+            )
 
-def init_db():
-    conn = get_db_connection()
+            # One transaction for the whole reload: a single commit instead of one per dish
+            c.execute("BEGIN")
+            c.execute("DELETE FROM dishes") # Clear old dishes
+            c.executemany(
+                "INSERT INTO dishes (name, description, price, image) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            bump_dishes_version(c)
+            c.execute("""
+                INSERT INTO meta (key, value) VALUES ('menu_signature', ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """, (signature,))
+            conn.commit()
+    except MENU_PARSE_ERRORS:
+        conn.rollback()
+        print("Error reading menu.json. Please check file format.")
+    finally:
+        conn.close()
+
+def migrate_legacy_orders(c):
+    """Splits line-item rows from orders_legacy into orders + order_items.
+
+    A legacy transaction is the set of rows sharing user_id, total_price and timestamp;
+    it keeps the id of its first row so existing order links stay valid.
+    """
+    c.execute("""
+        INSERT INTO orders (id, user_id, total_price, status, delivery_partner, timestamp)
+        SELECT MIN(id), user_id, total_price, status, delivery_partner, timestamp
+        FROM orders_legacy
+        GROUP BY user_id, total_price, timestamp
+    """)
+    c.execute("""
+        INSERT INTO order_items (order_id, dish_id, dish_name, quantity, total)
+        SELECT o.id, l.dish_id, l.dish_name, l.quantity, l.total
+        FROM orders_legacy l
+        JOIN orders o
+          ON o.user_id IS l.user_id AND o.total_price = l.total_price AND o.timestamp IS l.timestamp
+        ORDER BY l.id
+    """)
+    c.execute("DROP TABLE orders_legacy")
+
+def create_schema(conn):
     c = conn.cursor()
 
-    # Users: ADDED 'role' COLUMN
+    # Users: ADDED 'role' COLUMN. 'password' is legacy plaintext and is kept empty.
     c.execute('''CREATE TABLE IF NOT EXISTS users (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     username TEXT UNIQUE NOT NULL,
                     email TEXT UNIQUE NOT NULL,
                     password TEXT NOT NULL,
-                    role TEXT NOT NULL DEFAULT 'customer'
+                    role TEXT NOT NULL DEFAULT 'customer',
+                    password_hash BLOB
                 )''')
 
+    # Hash any plaintext passwords stored before password_hash existed
+    c.execute("PRAGMA table_info(users)")
+    if not any(col["name"] == "password_hash" for col in c.fetchall()):
+        c.execute("ALTER TABLE users ADD COLUMN password_hash BLOB")
+    c.execute("SELECT id, password FROM users WHERE password_hash IS NULL")
+    c.executemany(
+        "UPDATE users SET password_hash = ?, password = '' WHERE id = ?",
+        [(hash_password(user["password"]), user["id"]) for user in c.fetchall()]
+    )
+
     # Dishes
     c.execute('''CREATE TABLE IF NOT EXISTS dishes (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -71,24 +315,60 @@ def init_db():
                     FOREIGN KEY(dish_id) REFERENCES dishes(id)
                 )''')
 
-    # Orders: UPDATED to include status, delivery_partner, and total_price
+    # Older databases stored one orders row per line item; move it aside for migration
+    c.execute("PRAGMA table_info(orders)")
+    legacy_orders = any(col["name"] == "dish_id" for col in c.fetchall())
+    if legacy_orders:
+        c.execute("ALTER TABLE orders RENAME TO orders_legacy")
+
+    # Orders: one row per transaction, with status, delivery_partner, and total_price
     c.execute('''CREATE TABLE IF NOT EXISTS orders (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     user_id INTEGER,
-                    dish_id INTEGER,
-                    dish_name TEXT,
-                    quantity INTEGER,
-                    total REAL, -- Total for the line item
+                    total_price REAL NOT NULL, -- Total for the ENTIRE transaction
                     status TEXT NOT NULL DEFAULT 'placed',
                     delivery_partner TEXT,
-                    total_price REAL NOT NULL, -- Total for the ENTIRE transaction
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY(user_id) REFERENCES users(id)
                 )''')
-    conn.commit()
 
-    # Load dishes from json
-    load_menu_from_json()
+    # Order items: the line items of each order
+    c.execute('''CREATE TABLE IF NOT EXISTS order_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id INTEGER NOT NULL,
+                    dish_id INTEGER,
+                    dish_name TEXT,
+                    quantity INTEGER,
+                    total REAL, -- Total for the line item
+                    FOREIGN KEY(order_id) REFERENCES orders(id)
+                )''')
+
+    if legacy_orders:
+        migrate_legacy_orders(c)
+
+    # One cart row per (user, dish): fold duplicates left by the old SELECT-then-INSERT into the first row
+    c.execute("""
+        UPDATE cart SET quantity = (
+            SELECT SUM(c2.quantity) FROM cart c2
+            WHERE c2.user_id = cart.user_id AND c2.dish_id = cart.dish_id
+        )
+        WHERE id IN (SELECT MIN(id) FROM cart GROUP BY user_id, dish_id HAVING COUNT(*) > 1)
+    """)
+    c.execute("DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id, dish_id)")
+
+    # Indexes for the columns the routes filter and join on
+    c.execute("DROP INDEX IF EXISTS idx_cart_user")  # superseded by the unique index below
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_cart_user_dish ON cart(user_id, dish_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_ts ON orders(user_id, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_delivery ON orders(delivery_partner, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id)")
+
+    # Meta: small key/value store (e.g. the dishes cache version)
+    c.execute('''CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value
+                )''')
+    conn.commit()
 
     # Create initial users (Admin/Delivery) if they don't exist
     initial_users = [
@@ -100,23 +380,116 @@ def init_db():
         if c.fetchone() is None:
             try:
                 c.execute(
-                    "INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, ?)",
-                    (username, email, password, role)
+                    "INSERT INTO users (username, email, password, password_hash, role) VALUES (?, ?, '', ?, ?)",
+                    (username, email, hash_password(password), role)
                 )
                 conn.commit()
                 print(f"{role.capitalize()} user created: {email}/{password}")
             except sqlite3.IntegrityError:
                 pass
-            
+
+def init_db():
+    """Brings the schema up to date, skipping the work when it already is.
+
+    The schema is only (re)created when PRAGMA user_version is behind SCHEMA_VERSION.
+    Dishes are loaded separately by load_menu_if_changed().
+    """
+    conn = get_db_connection()
+    c = conn.cursor()
+    # WAL lets readers proceed while a writer commits; the setting is stored in the db file
+    c.execute("PRAGMA journal_mode=WAL")
+
+    c.execute("PRAGMA user_version")
+    if c.fetchone()[0] != SCHEMA_VERSION:
+        create_schema(conn)
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
     conn.close()
 
+def load_menu_if_changed():
+    """Loads dishes from menu.json unless it is unchanged since the last load."""
+    conn = get_db_connection()
+    c = conn.cursor()
+    c.execute("SELECT value FROM meta WHERE key = 'menu_signature'")
+    row = c.fetchone()
+    conn.close()
+
+    if row is None or row["value"] != menu_json_signature():
+        load_menu_from_json()
+
+@contextmanager
+def init_lock():
+    """File lock so concurrently booting workers run startup db work one at a time."""
+    with open(DB_NAME + ".lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+# Set once this process's menu load has finished; /menu waits on it briefly while the app warms up
+_menu_ready = threading.Event()
+# pid of the process that started the loader; threads don't survive a fork (gunicorn --preload)
+_menu_loader = {"pid": None}
+
+def load_menu_in_background():
+    try:
+        with init_lock():
+            load_menu_if_changed()
+    finally:
+        _menu_ready.set()
+
+def init_db_once():
+    """Creates the schema; the menu is loaded later, per process, by start_menu_loader()."""
+    with init_lock():
+        init_db()
+
+# Load the menu on a background thread in each serving process, on its first request
+@app.before_request
+def start_menu_loader():
+    if _menu_loader["pid"] != os.getpid():
+        _menu_loader["pid"] = os.getpid()
+        threading.Thread(target=load_menu_in_background, daemon=True).start()
+
+def menu_loaded(c):
+    """True once any process has loaded menu.json into the database."""
+    c.execute("SELECT 1 FROM meta WHERE key = 'menu_signature'")
+    return c.fetchone() is not None
+
+# Read the current user's id and role from the session once per request
+@app.before_request
+def load_current_user():
+    g.user_id = session.get('user_id')
+    g.role = session.get('role')
+    g.is_staff = g.role in ('admin', 'delivery')
+
 # Helper function for Role-Based Access Control (RBAC)
 def has_role(required_role):
-    return session.get('role') == required_role
+    return g.role == required_role
 
 # Helper function to check if the user is a staff member
 def is_staff():
-    return has_role('admin') or has_role('delivery')
+    return g.is_staff
+
+# Decorator for routes only logged-in customers may use
+def customer_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not g.user_id or g.is_staff:
+            flash("Access denied.", "error")
+            return redirect(url_for("home"))
+        return view(*args, **kwargs)
+    return wrapper
+
+# Decorator for routes restricted to one staff role
+def role_required(role):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not has_role(role):
+                flash(f"{role.capitalize()} access required.", "error")
+                return redirect(url_for("login"))
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # ---------------- CORE APPLICATION ROUTES (Customer/Guest) ----------------
 
@@ -130,12 +503,14 @@ def menu():
     if is_staff():
         flash("Menu access is restricted to customers/guests.", "error")
         return redirect(url_for("home"))
+
+    ready = _menu_ready.wait(timeout=0.1)
         
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM dishes")
-    dishes = c.fetchall()
-    conn.close()
+    with db_cursor() as c:
+        # While this process is still loading, serve the dishes an earlier load left in the db
+        if not ready and not menu_loaded(c):
+            return "The menu is still loading, please try again in a moment.", 503, {"Retry-After": "1"}
+        dishes = get_dishes(c)
     return render_template("menu.html", dishes=dishes, username=session.get("username"), role=session.get("role"))
 
 
@@ -145,83 +520,36 @@ def add_to_cart(dish_id):
         flash("You must be a customer to use the cart.", "error")
         return redirect(url_for("home"))
     
-    conn = get_db_connection()
-    c = conn.cursor()
     user_id = session["user_id"]
-
-    c.execute("SELECT id, quantity FROM cart WHERE user_id=? AND dish_id=?", (user_id, dish_id))
-    cart_item = c.fetchone()
-
-    if cart_item:
-        c.execute("UPDATE cart SET quantity = quantity + 1 WHERE id=?", (cart_item["id"],))
-    else:
-        c.execute("INSERT INTO cart (user_id, dish_id, quantity) VALUES (?, ?, 1)", (user_id, dish_id))
+    with db_cursor() as c:
+        # Inserts the dish or bumps its quantity in one statement
+        c.execute(SQL_ADD_TO_CART, (user_id, dish_id))
         
-    conn.commit()
-    conn.close()
     flash("Item added to cart!", "success")
     return redirect(url_for("menu"))
 
 
 @app.route("/cart")
+@customer_required
 def cart():
-    if not session.get("user_id") or is_staff():
-        flash("Access denied.", "error")
-        return redirect(url_for("home"))
-
-    conn = get_db_connection()
-    c = conn.cursor()
-    user_id = session["user_id"]
-    
-    c.execute("""
-        SELECT 
-            c.id AS cart_id, 
-            d.name, 
-            d.price, 
-            c.quantity, 
-            d.id AS dish_id
-        FROM cart c
-        JOIN dishes d ON c.dish_id = d.id
-        WHERE c.user_id = ?
-    """, (user_id,))
-    
-    cart_items = c.fetchall()
-    total = sum(item["price"] * item["quantity"] for item in cart_items)
-    
-    conn.close()
-    # The previous checkout.html/cart.html expect items in this format:
-    items = [{
-        "cart_id": item["cart_id"],
-        "name": item["name"],
-        "price": item["price"],
-        "quantity": item["quantity"],
-        "subtotal": item["price"] * item["quantity"]
-    } for item in cart_items]
+    with db_cursor() as c:
+        items, total = load_cart(c, session["user_id"])
     
     return render_template("cart.html", items=items, total=total, username=session.get("username"), role=session.get("role"))
 
 
 @app.route("/remove_from_cart/<int:cart_id>")
+@customer_required
 def remove_from_cart(cart_id):
-    if not session.get("user_id") or is_staff():
-        flash("Access denied.", "error")
-        return redirect(url_for("home"))
-
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM cart WHERE id=? AND user_id=?", (cart_id, session["user_id"]))
-    conn.commit()
-    conn.close()
+    with db_cursor() as c:
+        c.execute("DELETE FROM cart WHERE id=? AND user_id=?", (cart_id, session["user_id"]))
     flash("Item removed from cart.", "info")
     return redirect(url_for("cart"))
 
 
 @app.route("/details", methods=["GET", "POST"])
+@customer_required
 def details():
-    if not session.get("user_id") or is_staff():
-        flash("Access denied.", "error")
-        return redirect(url_for("home"))
-        
     if request.method == "POST":
         session["customer_name"] = request.form.get("name")
         session["customer_address"] = request.form.get("address")
@@ -232,136 +560,72 @@ def details():
 
 
 @app.route("/checkout")
+@customer_required
 def checkout():
-    if not session.get("user_id") or is_staff():
-        flash("Access denied.", "error")
-        return redirect(url_for("home"))
-        
     if "customer_name" not in session:
         return redirect(url_for("details"))
         
-    conn = get_db_connection()
-    c = conn.cursor()
-    user_id = session["user_id"]
-    
-    c.execute("""
-        SELECT d.name, d.price, c.quantity
-        FROM cart c
-        JOIN dishes d ON c.dish_id = d.id
-        WHERE c.user_id = ?
-    """, (user_id,))
-    
-    cart_items = c.fetchall()
-    total = 0
-    items = []
-    
-    for item in cart_items:
-        subtotal = item["price"] * item["quantity"]
-        total += subtotal
-        items.append({
-            "name": item["name"],
-            "price": item["price"],
-            "quantity": item["quantity"],
-            "subtotal": subtotal
-        })
+    with db_cursor() as c:
+        items, total = load_cart(c, session["user_id"])
         
-    conn.close()
     return render_template("checkout.html", items=items, total=total, username=session.get("username"), role=session.get("role"))
 
 
 @app.route("/payment_gateway")
+@customer_required
 def payment_gateway():
-    if not session.get("user_id") or is_staff():
-        flash("Access denied.", "error")
-        return redirect(url_for("home"))
-        
     if "customer_name" not in session:
         return redirect(url_for("details"))
         
-    conn = get_db_connection()
-    c = conn.cursor()
-    user_id = session["user_id"]
-    
-    c.execute("""
-        SELECT d.name, d.price, c.quantity
-        FROM cart c
-        JOIN dishes d ON c.dish_id = d.id
-        WHERE c.user_id = ?
-    """, (user_id,))
-    
-    cart_items = c.fetchall()
-    total = sum(item["price"] * item["quantity"] for item in cart_items)
-    
-    conn.close()
-    # The payment_gateway.html expects items in this format:
-    items = [{
-        "name": item["name"],
-        "quantity": item["quantity"],
-        "subtotal": item["price"] * item["quantity"]
-    } for item in cart_items]
+    with db_cursor() as c:
+        items, total = load_cart(c, session["user_id"])
     
     return render_template("payment_gateway.html", items=items, total=total, username=session.get("username"), role=session.get("role"))
 
 
 @app.route("/place_order_auto")
+@customer_required
 def place_order_auto():
-    if not session.get("user_id") or is_staff():
-        flash("Access denied.", "error")
-        return redirect(url_for("home"))
-
-    conn = get_db_connection()
-    c = conn.cursor()
     user_id = session["user_id"]
-    
-    c.execute("SELECT dish_id, quantity FROM cart WHERE user_id=?", (user_id,))
-    cart_items = c.fetchall()
-    
-    if not cart_items:
-        flash("Your cart is empty.", "error")
-        conn.close()
-        return redirect(url_for("cart"))
-
-    # 1. Calculate Grand Total and prepare item list
-    grand_total = 0
-    dish_items = []
-    
-    for item in cart_items:
-        c.execute("SELECT price, name FROM dishes WHERE id=?", (item["dish_id"],))
-        dish = c.fetchone()
-        if dish:
-            item_total = dish["price"] * item["quantity"]
-            grand_total += item_total
-            dish_items.append({
-                'dish_id': item["dish_id"],
-                'dish_name': dish["name"],
-                'quantity': item["quantity"],
-                'total': item_total
-            })
-    
-    # 2. Get a single timestamp for the entire order
-    current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-    # 3. Insert all line items into the orders table
-    first_order_id = None
-    for item in dish_items:
-        c.execute(
-            """
-            INSERT INTO orders 
-            (user_id, dish_id, dish_name, quantity, total, total_price, timestamp) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (user_id, item['dish_id'], item['dish_name'], item['quantity'], 
-             item['total'], grand_total, current_time)
+    with db_cursor() as c:
+        # Rows here are unpacked once and never reach a template, so skip building sqlite3.Row objects
+        c.row_factory = None
+        # Take the write lock before reading the cart, so an item added mid-checkout
+        # can't be cleared below without being part of the order
+        c.execute("BEGIN IMMEDIATE")
+    
+        # 1. Fetch the cart together with each dish's name, price and the grand total
+        cart_items, grand_total = load_cart(c, user_id)
+    
+        if not cart_items:
+            flash("Your cart is empty.", "error")
+            return redirect(url_for("cart"))
+
+        # 2. Get a single timestamp for the entire order
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+        # 3. Insert the order, then all of its line items, in the same transaction as the cart clear
+        c.execute(SQL_INSERT_ORDER, (user_id, grand_total, current_time))
+        order_id, total_price, status, delivery_partner, timestamp = c.fetchone()
+        c.executemany(
+            SQL_INSERT_ORDER_ITEM,
+            [(order_id, dish_id, name, quantity, subtotal)
+             for _cart_id, dish_id, name, _price, quantity, subtotal, _grand_total in cart_items]
         )
-        if first_order_id is None:
-            first_order_id = c.lastrowid
-            
-    # 4. Clear the cart
-    c.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
 
-    return redirect(url_for("payment_success", order_id=first_order_id))
+        # 4. Clear the cart
+        c.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
+
+    # payment_success renders this once instead of reading the order straight back
+    session["last_order"] = {
+        "id": order_id,
+        "total_price": total_price,
+        "status": status,
+        "delivery_partner": delivery_partner,
+        "timestamp": timestamp,
+    }
+
+    return redirect(url_for("payment_success", order_id=order_id))
 
 
 @app.route("/payment_success")
@@ -370,34 +634,25 @@ def payment_success():
         flash("Please log in first!", "error")
         return redirect(url_for("login"))
 
-    # We use order_id only as a reference to fetch the unique order's details (timestamp and total_price)
     order_id = request.args.get("order_id")
     if not order_id:
         flash("No order found! Returning to home.", "error")
         return redirect(url_for("home"))
     
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    # Fetch the unique identifier for this order (total_price and timestamp)
-    c.execute("SELECT total_price, status, delivery_partner, timestamp FROM orders WHERE id=?", (order_id,))
-    ref_order = c.fetchone()
+    # Use the order just placed if this is it, otherwise fetch the order itself
+    ref_order = session.pop("last_order", None)
+    with db_cursor() as c:
+        if not ref_order or str(ref_order["id"]) != order_id:
+            c.execute(SQL_USER_ORDER, (order_id, session['user_id']))
+            ref_order = c.fetchone()
     
-    if not ref_order:
-        flash("Order reference not found!", "error")
-        conn.close()
-        return redirect(url_for("home"))
+        if not ref_order:
+            flash("Order reference not found!", "error")
+            return redirect(url_for("home"))
         
-    # Fetch all line items matching the unique identifier
-    c.execute("""
-        SELECT dish_name, quantity, total 
-        FROM orders 
-        WHERE total_price = ? AND timestamp = ? AND user_id = ?
-        ORDER BY id
-    """, (ref_order['total_price'], ref_order['timestamp'], session['user_id']))
-    
-    line_items = c.fetchall()
-    conn.close()
+        # Fetch all line items of the order
+        c.execute(SQL_ORDER_ITEMS, (order_id,))
+        line_items = c.fetchall()
 
     return render_template(
         "payment_success.html",
@@ -422,18 +677,20 @@ def register():
         username = request.form.get("username")
         email = request.form.get("email")
         password = request.form.get("password")
-        conn = get_db_connection()
-        c = conn.cursor()
-        try:
-            # New users default to 'customer' role
-            c.execute("INSERT INTO users (username, email, password, role) VALUES (?, ?, ?, 'customer')", (username, email, password))
-            conn.commit()
-            flash("Registration successful! Please login.", "success")
-            return redirect(url_for("login"))
-        except sqlite3.IntegrityError:
-            flash("Username or Email already exists!", "error")
-        finally:
-            conn.close()
+        if not password:
+            flash("Password is required!", "error")
+            return render_template("register.html")
+        with db_cursor() as c:
+            try:
+                # New users default to 'customer' role
+                c.execute(
+                    "INSERT INTO users (username, email, password, password_hash, role) VALUES (?, ?, '', ?, 'customer')",
+                    (username, email, hash_password(password))
+                )
+                flash("Registration successful! Please login.", "success")
+                return redirect(url_for("login"))
+            except sqlite3.IntegrityError:
+                flash("Username or Email already exists!", "error")
     return render_template("register.html")
 
 
@@ -442,17 +699,19 @@ def login():
     if request.method == "POST":
         email = request.form.get("email")
         password = request.form.get("password")
-        conn = get_db_connection()
-        c = conn.cursor()
-        # Select role along with id and username
-        c.execute("SELECT id, username, role FROM users WHERE email=? AND password=?", (email, password))
-        user = c.fetchone()
-        conn.close()
+        with db_cursor() as c:
+            # Look the user up by email only, then verify the password hash
+            c.execute("SELECT id, username, email, role, password_hash FROM users WHERE email=?", (email,))
+            user = c.fetchone()
         
-        if user:
+        # Always run scrypt, even for unknown emails, so timing doesn't reveal which accounts exist
+        stored_hash = user["password_hash"] if user else DUMMY_PASSWORD_HASH
+        if check_password(password or "", stored_hash) and user:
             session["user_id"] = user["id"]
             session["username"] = user["username"]
             session["role"] = user["role"]
+            # Kept in the signed session cookie so profile pages need no users lookup
+            session["email"] = user["email"]
             
             flash(f"Login successful as {user['role'].capitalize()}!", "success")
             
@@ -481,26 +740,17 @@ def profile():
         flash("Please log in to view your profile.", "error")
         return redirect(url_for("login"))
     
-    conn = get_db_connection()
-    c = conn.cursor()
-
-    c.execute("SELECT * FROM users WHERE id=?", (session['user_id'],))
-    user = c.fetchone()
+    with db_cursor() as c:
+        # The user's details travel in the session; only sessions from before email was stored hit the db
+        if "email" in session:
+            user = {"username": session["username"], "email": session["email"], "role": session["role"]}
+        else:
+            c.execute("SELECT * FROM users WHERE id=?", (session['user_id'],))
+            user = c.fetchone()
 
-    # Fetch all unique orders for the current user
-    # Orders are grouped by total_price and timestamp to represent a single transaction
-    c.execute("""
-        SELECT 
-            id, total_price, status, delivery_partner, timestamp
-        FROM orders
-        WHERE user_id=?
-        GROUP BY total_price, timestamp, delivery_partner, status 
-        ORDER BY timestamp DESC
-    """, (session['user_id'],))
-    
-    order_summaries = c.fetchall() 
-    
-    conn.close()
+        # Fetch all orders for the current user
+        c.execute(SQL_USER_ORDERS, (session['user_id'],))
+        order_summaries = c.fetchall() 
     
     return render_template("profile.html", 
         user=user, 
@@ -512,83 +762,47 @@ def profile():
 # ---------------- ADMIN ROUTES (Order & Menu Management) ----------------
 
 @app.route("/admin")
+@role_required('admin')
 def admin_dashboard():
-    if not has_role('admin'):
-        flash("Admin access required.", "error")
-        return redirect(url_for("login"))
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    # 1. Fetch all unique orders (grouped by transaction identifier)
-    c.execute("""
-        SELECT 
-            id, user_id, total_price, status, delivery_partner, timestamp
-        FROM orders 
-        GROUP BY total_price, timestamp, delivery_partner, status
-        ORDER BY timestamp DESC
-    """)
-    orders = c.fetchall()
+    with db_cursor() as c:
+        # 1. Fetch all orders with the customer's name
+        c.execute(SQL_ALL_ORDERS)
+        orders = c.fetchall()
 
-    # 2. Fetch all delivery partners
-    c.execute("SELECT username FROM users WHERE role='delivery'")
-    delivery_list = c.fetchall()
-    
-    # 3. Enhance orders with customer name
-    enhanced_orders = []
-    for order in orders:
-        c.execute("SELECT username FROM users WHERE id=?", (order['user_id'],))
-        customer_result = c.fetchone()
-        customer_username = customer_result['username'] if customer_result else 'Unknown User'
-
-        enhanced_orders.append({
-            'id': order['id'], # This is the first order item ID, used as a reference
-            'customer_username': customer_username,
-            'total': order['total_price'],
-            'status': order['status'],
-            'delivery_partner': order['delivery_partner'],
-            'timestamp': order['timestamp']
-        })
-    
-    conn.close()
+        # 2. Fetch all delivery partners
+        c.execute("SELECT username FROM users WHERE role='delivery'")
+        delivery_list = c.fetchall()
     
     return render_template("admin_orders.html", 
-        orders=enhanced_orders, 
+        orders=orders, 
         delivery_list=delivery_list,
         username=session.get("username"),
         role=session.get("role")
     )
 
 @app.route("/admin/menu", methods=["GET", "POST"])
+@role_required('admin')
 def admin_menu():
-    if not has_role('admin'):
-        flash("Admin access required.", "error")
-        return redirect(url_for("login"))
-
-    conn = get_db_connection()
-    c = conn.cursor()
-    
-    if request.method == "POST":
-        name = request.form.get("name")
-        price = request.form.get("price")
-        description = request.form.get("description", "")
-        image = request.form.get("image", "default.png") 
+    with db_cursor() as c:
+        if request.method == "POST":
+            name = request.form.get("name")
+            price = request.form.get("price")
+            description = request.form.get("description", "")
+            image = request.form.get("image", "default.png") 
         
-        try:
-            c.execute(
-                "INSERT INTO dishes (name, price, description, image) VALUES (?, ?, ?, ?)",
-                (name, float(price), description, image)
-            )
-            conn.commit()
-            flash(f"Dish '{name}' added successfully!", "success")
-        except ValueError:
-            flash("Invalid price.", "error")
-        except sqlite3.Error as e:
-            flash(f"Database error: {e}", "error")
-
-    c.execute("SELECT * FROM dishes ORDER BY name")
-    dishes = c.fetchall()
-    conn.close()
+            try:
+                c.execute(
+                    "INSERT INTO dishes (name, price, description, image) VALUES (?, ?, ?, ?)",
+                    (name, float(price), description, image)
+                )
+                bump_dishes_version(c)
+                flash(f"Dish '{name}' added successfully!", "success")
+            except ValueError:
+                flash("Invalid price.", "error")
+            except sqlite3.Error as e:
+                flash(f"Database error: {e}", "error")
+
+        dishes = sorted(get_dishes(c), key=lambda dish: dish["name"])
     
     return render_template("admin_menu.html", 
         dishes=dishes,
@@ -597,116 +811,56 @@ def admin_menu():
     )
 
 @app.route("/admin/delete_dish/<int:dish_id>")
+@role_required('admin')
 def admin_delete_dish(dish_id):
-    if not has_role('admin'):
-        flash("Admin access required.", "error")
-        return redirect(url_for("login"))
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("DELETE FROM dishes WHERE id=?", (dish_id,))
-    conn.commit()
-    conn.close()
+    with db_cursor() as c:
+        c.execute("DELETE FROM dishes WHERE id=?", (dish_id,))
+        bump_dishes_version(c)
     flash("Dish deleted successfully.", "info")
     return redirect(url_for("admin_menu"))
 
 @app.route("/admin/assign/<int:order_id>", methods=["POST"])
+@role_required('admin')
 def admin_assign(order_id):
-    if not has_role('admin'):
-        flash("Admin access required.", "error")
-        return redirect(url_for("login"))
-
     delivery_user = request.form.get("delivery_user")
     
-    conn = get_db_connection()
-    c = conn.cursor()
+    with db_cursor() as c:
+        c.execute(SQL_ASSIGN_ORDER, (delivery_user, order_id))
     
-    # Get the unique identifier for the order using the reference ID
-    c.execute("SELECT total_price, timestamp FROM orders WHERE id=?", (order_id,))
-    ref_order = c.fetchone()
-    
-    if ref_order:
-        # Update ALL line items belonging to the same unique order
-        c.execute(
-            """
-            UPDATE orders 
-            SET delivery_partner = ?, status = 'preparing' 
-            WHERE total_price = ? AND timestamp = ?
-            """,
-            (delivery_user, ref_order['total_price'], ref_order['timestamp'])
-        )
-        conn.commit()
+    if c.rowcount:
         flash(f"Order #{order_id} assigned to {delivery_user} and status set to 'Preparing'.", "success")
     else:
         flash("Order not found.", "error")
         
-    conn.close()
     return redirect(url_for("admin_dashboard"))
 
 @app.route("/admin/update_status/<int:order_id>", methods=["POST"])
+@role_required('admin')
 def admin_update_status(order_id):
-    if not has_role('admin'):
-        flash("Admin access required.", "error")
-        return redirect(url_for("login"))
-
     new_status = request.form.get("status")
     
-    conn = get_db_connection()
-    c = conn.cursor()
+    with db_cursor() as c:
+        c.execute(SQL_UPDATE_ORDER_STATUS, (new_status, order_id))
     
-    # Get the unique identifier for the order using the reference ID
-    c.execute("SELECT total_price, timestamp FROM orders WHERE id=?", (order_id,))
-    ref_order = c.fetchone()
-    
-    if ref_order:
-        # Update ALL line items belonging to the same unique order
-        c.execute(
-            """
-            UPDATE orders 
-            SET status = ? 
-            WHERE total_price = ? AND timestamp = ?
-            """,
-            (new_status, ref_order['total_price'], ref_order['timestamp'])
-        )
-        conn.commit()
+    if c.rowcount:
         flash(f"Order #{order_id} status updated to {new_status}.", "success")
     else:
         flash("Order not found.", "error")
         
-    conn.close()
     return redirect(url_for("admin_dashboard"))
 
 
 # ---------------- DELIVERY ROUTES ----------------
 
 @app.route("/delivery")
+@role_required('delivery')
 def delivery_dashboard():
-    if not has_role('delivery'):
-        flash("Delivery access required.", "error")
-        return redirect(url_for("login"))
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    
     delivery_user = session['username']
     
-    # Fetch unique orders assigned to this delivery partner
-    c.execute("""
-        SELECT 
-            o.id, 
-            u.username AS customer_username, 
-            o.total_price, 
-            o.status, 
-            o.timestamp
-        FROM orders o
-        JOIN users u ON o.user_id = u.id
-        WHERE o.delivery_partner = ?
-        GROUP BY o.total_price, o.timestamp, o.status
-        ORDER BY o.timestamp DESC
-    """, (delivery_user,))
-    assigned_orders = c.fetchall()
-    
-    conn.close()
+    with db_cursor() as c:
+        # Fetch orders assigned to this delivery partner
+        c.execute(SQL_DELIVERY_ORDERS, (delivery_user,))
+        assigned_orders = c.fetchall()
     
     return render_template("delivery_dashboard.html", 
         orders=assigned_orders,
@@ -715,41 +869,26 @@ def delivery_dashboard():
     )
     
 @app.route("/delivery/update_status/<int:order_id>", methods=["POST"])
+@role_required('delivery')
 def delivery_update_status(order_id):
-    if not has_role('delivery'):
-        flash("Delivery access required.", "error")
-        return redirect(url_for("login"))
-
     new_status = request.form.get("status")
     delivery_user = session['username']
     
-    conn = get_db_connection()
-    c = conn.cursor()
+    with db_cursor() as c:
+        # Only matches if the order is assigned to the current user
+        c.execute(SQL_UPDATE_DELIVERY_STATUS, (new_status, order_id, delivery_user))
     
-    # Get the unique identifier for the order and ensure it's assigned to the current user
-    c.execute("SELECT total_price, timestamp FROM orders WHERE id=? AND delivery_partner=?", (order_id, delivery_user))
-    ref_order = c.fetchone()
-    
-    if ref_order:
-        # Update ALL line items belonging to the same unique order
-        c.execute(
-            """
-            UPDATE orders 
-            SET status = ? 
-            WHERE total_price = ? AND timestamp = ? AND delivery_partner = ?
-            """,
-            (new_status, ref_order['total_price'], ref_order['timestamp'], delivery_user)
-        )
-        conn.commit()
+    if c.rowcount:
         flash(f"Order #{order_id} status updated to {new_status}.", "success")
     else:
         flash("Order not found or not assigned to you.", "error")
         
-    conn.close()
     return redirect(url_for("delivery_dashboard"))
 
 
 # ---------------- MAIN ----------------
+# Runs on import so WSGI servers (gunicorn app:app) get an initialized database too
+init_db_once()
+
 if __name__ == "__main__":
-    init_db()
     app.run(debug=True)
\ No newline at end of file